@@ -5,14 +5,22 @@ import logging
 import subprocess
 import shutil
 import signal
+import sys
 import atexit
 import gc
+import functools
+import hashlib
+import queue
+import re
+import string
+import threading
 from datetime import datetime
 from flask import Flask, request, jsonify
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 from dotenv import load_dotenv
+from PIL import Image, ImageDraw, ImageFont
 
 # Load environment variables
 load_dotenv()
@@ -22,6 +30,28 @@ class Config:
     FONT_FILE = "Poppins-Regular.ttf"
     TOP_IMAGE = "image.png"
     END_CREDIT = "end_credit.png"
+    VAAPI_DEVICE = "/dev/dri/renderD128"
+    X264_PRESET = os.getenv('X264_PRESET', 'faster')
+    # Keep per-request working files on tmpfs when the host provides one with room to spare
+    USE_SHM_TEMP = os.getenv('USE_SHM_TEMP', '1') == '1'
+    SHM_DIR = "/dev/shm"
+    SHM_MIN_FREE_BYTES = int(os.getenv('SHM_MIN_FREE_BYTES', 2 * 1024 ** 3))
+    TEMP_ROOT = None
+    # 0 turns pooling off; queue.Queue(maxsize=0) would be unbounded instead
+    TEMP_DIR_POOL_SIZE = max(0, int(os.getenv('TEMP_DIR_POOL_SIZE', 4)))
+    ASSET_CACHE_DIR = os.path.join(tempfile.gettempdir(), "video_splitter_assets")
+    # Set by prepare_assets() to paths keyed on how each asset is rendered
+    TOP_IMAGE_SCALED = None
+    END_CREDIT_CLIP = None
+    END_CREDIT_DURATION = 3
+    # Parts encoded by one ffmpeg process; keeps concurrent encoders at workers x this
+    SEGMENT_BATCH_SIZE = max(1, int(os.getenv('SEGMENT_BATCH_SIZE', 2)))
+    CAPTION_Y = 1220
+    CAPTION_SIZE = (1080, 120)
+    CAPTION_FONT_SIZE = 48
+    CAPTION_LINE_HEIGHT = 46
+    OUTPUT_FPS = 30
+    AUDIO_SAMPLE_RATE = 48000
 
 # Configure logging with more detailed format
 logging.basicConfig(
@@ -36,19 +66,45 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+def shm_has_room():
+    try:
+        return shutil.disk_usage(Config.SHM_DIR).free >= Config.SHM_MIN_FREE_BYTES
+    except OSError:
+        return False
+
+def select_temp_root():
+    if not Config.USE_SHM_TEMP or not os.path.isdir(Config.SHM_DIR):
+        return None
+    if not shm_has_room():
+        logger.warning(f"⚠️ {Config.SHM_DIR} has less than {Config.SHM_MIN_FREE_BYTES} bytes free, using disk temp dir")
+        return None
+    return Config.SHM_DIR
+
+Config.TEMP_ROOT = select_temp_root()
+logger.info(f"📁 Temp root: {Config.TEMP_ROOT or tempfile.gettempdir()}")
+
 # Store active temp directories for cleanup
 active_temp_dirs = set()
+# Re-entrant so the signal handler can't deadlock against the thread it interrupted
+active_temp_dirs_lock = threading.RLock()
+# Emptied working directories waiting to be reused by the next request;
+# filled only by recycle_temp_dir, so an idle worker holds none
+temp_dir_pool = queue.Queue(maxsize=Config.TEMP_DIR_POOL_SIZE)
 
 def cleanup_all_temp_dirs():
     global active_temp_dirs
-    for temp_dir in list(active_temp_dirs):
+    with active_temp_dirs_lock:
+        temp_dirs = list(active_temp_dirs)
+        active_temp_dirs.clear()
+        while not temp_dir_pool.empty():
+            temp_dirs.append(temp_dir_pool.get_nowait())
+    for temp_dir in temp_dirs:
         try:
             if os.path.exists(temp_dir):
                 shutil.rmtree(temp_dir)
                 logger.info(f"✅ Cleaned up temp directory: {temp_dir}")
         except Exception as e:
             logger.warning(f"⚠️ Error cleaning up temp directory {temp_dir}: {str(e)}")
-    active_temp_dirs.clear()
 
 def signal_handler(signum, frame):
     logger.info(f"🔄 Received signal {signum}, cleaning up...")
@@ -56,8 +112,6 @@ def signal_handler(signum, frame):
     exit(0)
 
 atexit.register(cleanup_all_temp_dirs)
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
 
 cloudinary.config(
     cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
@@ -67,14 +121,81 @@ cloudinary.config(
 
 def add_temp_dir(temp_dir):
     global active_temp_dirs
-    active_temp_dirs.add(temp_dir)
+    with active_temp_dirs_lock:
+        active_temp_dirs.add(temp_dir)
     logger.info(f"📁 Added temp directory: {temp_dir}")
 
+def create_temp_dir(prefix="video_split_"):
+    if Config.TEMP_ROOT == Config.SHM_DIR and not shm_has_room():
+        # tmpfs is filling up with other in-flight requests; spill this one to disk
+        temp_dir = tempfile.mkdtemp(prefix=prefix)
+        add_temp_dir(temp_dir)
+        return temp_dir
+    # Take from the pool and track under one lock so cleanup never sees the
+    # directory in neither place
+    with active_temp_dirs_lock:
+        temp_dir = None
+        while temp_dir is None:
+            try:
+                temp_dir = temp_dir_pool.get_nowait()
+            except queue.Empty:
+                temp_dir = tempfile.mkdtemp(prefix=prefix, dir=Config.TEMP_ROOT)
+            if not os.path.isdir(temp_dir):
+                # Removed from under the pool, e.g. by a tmp reaper
+                temp_dir = None
+        add_temp_dir(temp_dir)
+    return temp_dir
+
 def remove_temp_dir(temp_dir):
     global active_temp_dirs
-    active_temp_dirs.discard(temp_dir)
+    with active_temp_dirs_lock:
+        active_temp_dirs.discard(temp_dir)
     logger.info(f"🗑️ Removed temp directory from tracking: {temp_dir}")
 
+def delete_temp_dir(temp_dir):
+    # Per-request cleanup: only this request's directory, never the other in-flight ones
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    remove_temp_dir(temp_dir)
+
+def empty_dir(path):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+def recycle_temp_dir(temp_dir):
+    # Empty the directory and hand it back to the pool instead of paying for a
+    # rmdir/mkdtemp pair on every request; drop it once the pool is full
+    try:
+        empty_dir(temp_dir)
+    except OSError as e:
+        logger.warning(f"⚠️ Could not empty {temp_dir}, deleting it: {str(e)}")
+        delete_temp_dir(temp_dir)
+        return
+    if Config.TEMP_DIR_POOL_SIZE == 0 or os.path.dirname(temp_dir) != (Config.TEMP_ROOT or tempfile.gettempdir()):
+        # Pooling is off, or it spilled to disk while tmpfs was full
+        delete_temp_dir(temp_dir)
+        return
+    # Pool it before untracking it, so an exit cleanup in between still finds it
+    with active_temp_dirs_lock:
+        try:
+            temp_dir_pool.put_nowait(temp_dir)
+        except queue.Full:
+            pooled = False
+        else:
+            pooled = True
+            remove_temp_dir(temp_dir)
+    if not pooled:
+        delete_temp_dir(temp_dir)
+
+def discard_temp_dir(temp_dir):
+    # The directory stays tracked and out of the pool until it is empty, so
+    # the response isn't held up by the tree walk and no one reuses it early
+    threading.Thread(target=recycle_temp_dir, args=(temp_dir,), daemon=True).start()
+
+@functools.lru_cache(maxsize=1)
 def check_ffmpeg():
     try:
         result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=10)
@@ -85,46 +206,381 @@ def check_ffmpeg():
         logger.error(f"❌ FFmpeg check failed: {str(e)}")
         return False
 
-def process_segment(segment_path, idx, movie_name, output_dir):
-    output_file = os.path.join(output_dir, f"{movie_name}_part_{idx:03d}.mp4")
+def probe_encoders():
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, timeout=10)
+        return result.stdout if result.returncode == 0 else ""
+    except (FileNotFoundError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"⚠️ FFmpeg encoder probe failed: {str(e)}")
+        return ""
 
-    ffmpeg_command = [
-        "ffmpeg",
-        "-i", segment_path,
-        "-loop", "1", "-t", "3", "-i", Config.END_CREDIT,
-        "-i", Config.TOP_IMAGE,
-        "-filter_complex",
-        f"""
-        [2:v]scale=1080:-1,setsar=1[top];
-        [0:v]scale=1080:1312:force_original_aspect_ratio=decrease,pad=1080:1920:0:608:color=black,setsar=1[main];
-        [main][top]overlay=0:0[over];
-        [over]drawtext=text='Part No - {idx}':fontfile={Config.FONT_FILE}:fontsize=48:fontcolor=white:x=(w-tw)/2:y=1220[txt1];
-        [txt1]drawtext=text='{movie_name}':fontfile={Config.FONT_FILE}:fontsize=48:fontcolor=white:x=(w-tw)/2:y=1266[txt2];
-        [1:v]scale=1080:1920,setsar=1[end];
-        [txt2][end]concat=n=2:v=1:a=0[outv];
-        [0:a]aresample=async=1[outa]
-        """.replace("\n", ""),
-        "-map", "[outv]",
-        "-map", "[outa]",
-        "-c:v", "libx264",
-        "-preset", "ultrafast",
-        "-crf", "23",
+check_ffmpeg()
+AVAILABLE_ENCODERS = probe_encoders()
+
+def video_input_args(encoder=None):
+    if (encoder or VIDEO_ENCODER) == "h264_vaapi":
+        return ["-vaapi_device", Config.VAAPI_DEVICE]
+    return []
+
+def video_output_filter(encoder=None):
+    encoder = encoder or VIDEO_ENCODER
+    # VAAPI encodes from GPU surfaces, so frames are uploaded at the end of the graph
+    if encoder == "h264_vaapi":
+        return ",format=nv12,hwupload"
+    # QSV takes system-memory NV12 and uploads it inside the encoder session
+    if encoder == "h264_qsv":
+        return ",format=nv12"
+    return ",format=yuv420p"
+
+def video_encoder_args(encoder=None):
+    encoder = encoder or VIDEO_ENCODER
+    if encoder == "h264_nvenc":
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "ll", "-rc", "vbr", "-cq", "23", "-b:v", "0"]
+    if encoder == "h264_qsv":
+        return ["-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "23"]
+    if encoder == "h264_vaapi":
+        return ["-c:v", "h264_vaapi", "-b:v", "3000k"]
+    return ["-c:v", "libx264", "-preset", Config.X264_PRESET, "-crf", "23"]
+
+def encoder_works(encoder):
+    # A listed encoder only means it was compiled in; a tiny test encode
+    # confirms the driver and device are actually usable on this host
+    try:
+        result = subprocess.run([
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            *video_input_args(encoder),
+            "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.2",
+            "-vf", f"null{video_output_filter(encoder)}",
+            *video_encoder_args(encoder),
+            "-f", "null", "-"
+        ], capture_output=True, text=True, timeout=30)
+    except (FileNotFoundError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"⚠️ {encoder} test encode failed: {str(e)}")
+        return False
+    if result.returncode != 0:
+        logger.warning(f"⚠️ {encoder} is listed but unusable: {result.stderr.strip()}")
+    return result.returncode == 0
+
+def select_video_encoder():
+    # Test-encode in order of preference and stop at the first that works,
+    # so a host with NVENC doesn't also pay for the QSV and VAAPI probes
+    if 'h264_nvenc' in AVAILABLE_ENCODERS and encoder_works("h264_nvenc"):
+        return "h264_nvenc"
+    if 'h264_qsv' in AVAILABLE_ENCODERS and encoder_works("h264_qsv"):
+        return "h264_qsv"
+    if (
+        'h264_vaapi' in AVAILABLE_ENCODERS
+        and os.path.exists(Config.VAAPI_DEVICE)
+        and encoder_works("h264_vaapi")
+    ):
+        return "h264_vaapi"
+    return "libx264"
+
+VIDEO_ENCODER = select_video_encoder()
+logger.info(f"🎬 Video encoder: {VIDEO_ENCODER}")
+
+def output_encoding_args(threads=0):
+    # Every clip shares these parameters so the end credit can be stream-copied onto each part
+    return [
+        "-r", str(Config.OUTPUT_FPS),
+        *video_encoder_args(),
+        "-threads", str(threads),
         "-c:a", "aac",
         "-b:a", "128k",
+        "-ar", str(Config.AUDIO_SAMPLE_RATE),
+        "-ac", "2",
+        "-video_track_timescale", str(Config.OUTPUT_FPS * 512)
+    ]
+
+def asset_path(name, ffmpeg_args, source):
+    # Key the cached file on its render arguments and source, so a file left
+    # behind by a process with another encoder or preset is never reused
+    try:
+        source_mtime = os.path.getmtime(source)
+    except OSError:
+        source_mtime = 0
+    key = hashlib.sha1(repr((ffmpeg_args, source_mtime)).encode()).hexdigest()[:12]
+    root, ext = os.path.splitext(name)
+    return os.path.join(Config.ASSET_CACHE_DIR, f"{root}_{key}{ext}")
+
+def render_asset(target, ffmpeg_args):
+    # Render to a per-process name first so concurrent workers never read a partial file
+    root, ext = os.path.splitext(target)
+    staging = f"{root}.{os.getpid()}{ext}"
+    try:
+        subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", *ffmpeg_args, "-y", staging], check=True, timeout=120)
+        os.replace(staging, target)
+        logger.info(f"🖼️ Rendered asset: {target}")
+        return True
+    except (FileNotFoundError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        logger.error(f"❌ Failed to render asset {target}: {str(e)}")
+        if os.path.exists(staging):
+            os.remove(staging)
+        return False
+
+def asset_render_args():
+    top_image_args = [
+        "-i", Config.TOP_IMAGE,
+        "-vf", "scale=1080:-1,setsar=1",
+        "-frames:v", "1", "-update", "1"
+    ]
+    end_credit_args = [
+        *video_input_args(),
+        "-loop", "1", "-framerate", str(Config.OUTPUT_FPS), "-t", str(Config.END_CREDIT_DURATION), "-i", Config.END_CREDIT,
+        "-f", "lavfi", "-t", str(Config.END_CREDIT_DURATION), "-i", f"anullsrc=r={Config.AUDIO_SAMPLE_RATE}:cl=stereo",
+        "-vf", f"scale=1080:1920,setsar=1{video_output_filter()}",
+        *output_encoding_args()
+    ]
+    return top_image_args, end_credit_args
+
+def prepare_assets():
+    # Only resolve the paths at import; the renders happen on first use
+    top_image_args, end_credit_args = asset_render_args()
+    Config.TOP_IMAGE_SCALED = asset_path("image_1080.png", top_image_args, Config.TOP_IMAGE)
+    Config.END_CREDIT_CLIP = asset_path("end_credit.mp4", end_credit_args, Config.END_CREDIT)
+
+prepare_assets()
+assets_lock = threading.Lock()
+
+def require_assets():
+    # Renders land via os.replace, so a file under its keyed name is always
+    # complete and can be reused; a failed render is retried on the next request
+    with assets_lock:
+        os.makedirs(Config.ASSET_CACHE_DIR, exist_ok=True)
+        for target, ffmpeg_args in zip((Config.TOP_IMAGE_SCALED, Config.END_CREDIT_CLIP), asset_render_args()):
+            if not os.path.exists(target) and not render_asset(target, ffmpeg_args):
+                raise RuntimeError(f"Could not render {target}; check the FFmpeg logs")
+
+def concat_file_entry(path):
+    escaped = os.path.abspath(path).replace("'", "'\\''")
+    return f"file '{escaped}'\n"
+
+def safe_filename(name):
+    # Whitelist what may reach the filesystem; the caller's name is only used for display
+    return re.sub(r"[^\w\-]+", "_", name).strip("_") or "video"
+
+def render_captions(batch, bases, movie_name):
+    # Rasterizing the two caption lines once per part and blending the bitmap
+    # keeps FreeType out of the encode, where drawtext would run every frame
+    font = ImageFont.truetype(Config.FONT_FILE, Config.CAPTION_FONT_SIZE)
+    for (_, idx), base in zip(batch, bases):
+        caption = Image.new("RGBA", Config.CAPTION_SIZE, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(caption)
+        for line_no, text in enumerate((f"Part No - {idx}", movie_name)):
+            draw.text((Config.CAPTION_SIZE[0] // 2, line_no * Config.CAPTION_LINE_HEIGHT), text, font=font, fill="white", anchor="ma")
+        caption.save(f"{base}_caption.png")
+
+def build_segment_filter_template():
+    # Everything except the input indexes and the output label is fixed for
+    # the life of the process, so assemble it once
+    return string.Template(
+        "[${input}:v]scale=1080:1312:force_original_aspect_ratio=decrease,pad=1080:1920:0:608:color=black,setsar=1[main${n}];"
+        "[main${n}][top${n}]overlay=0:0[over${n}];"
+        f"[over${{n}}][${{caption}}:v]overlay=0:{Config.CAPTION_Y}{video_output_filter()}[outv${{n}}];"
+        "[${input}:a]aresample=async=1[outa${n}]"
+    )
+
+SEGMENT_FILTER_TEMPLATE = build_segment_filter_template()
+
+def append_end_credit(body_file, output_file, concat_list):
+    # The end credit is already encoded with matching parameters, so appending it is a remux
+    with open(concat_list, "w") as f:
+        f.write(concat_file_entry(body_file) + concat_file_entry(Config.END_CREDIT_CLIP))
+    subprocess.run([
+        "ffmpeg",
+        "-f", "concat", "-safe", "0",
+        "-i", concat_list,
+        "-c", "copy",
         "-y",
         output_file
-    ]
+    ], check=True)
+
+INTERMEDIATE_SUFFIXES = ("_body.mp4", "_concat.txt", "_caption.png", "_filters.txt")
+
+def segment_bases(batch, movie_name, output_dir):
+    name = safe_filename(movie_name)
+    return [os.path.join(output_dir, f"{name}_part_{idx:03d}") for _, idx in batch]
+
+def batch_command(batch, bases, movie_name, threads=0):
+    # A single ffmpeg process encodes the whole batch, so startup and codec
+    # init are paid once per batch instead of once per segment
+    render_captions(batch, bases, movie_name)
+    ffmpeg_command = ["ffmpeg", "-y", *video_input_args(), "-i", Config.TOP_IMAGE_SCALED]
+    filters = [f"[0:v]split={len(batch)}" + "".join(f"[top{n}]" for n in range(len(batch)))]
+    for n, ((segment_path, _), base) in enumerate(zip(batch, bases)):
+        ffmpeg_command += ["-i", segment_path, "-i", f"{base}_caption.png"]
+        filters.append(SEGMENT_FILTER_TEMPLATE.substitute(input=2 * n + 1, caption=2 * n + 2, n=n))
+
+    filter_script = f"{bases[0]}_filters.txt"
+    with open(filter_script, "w") as f:
+        f.write(";\n".join(filters))
+
+    ffmpeg_command += ["-filter_complex_script", filter_script]
+    for n, base in enumerate(bases):
+        ffmpeg_command += ["-map", f"[outv{n}]", "-map", f"[outa{n}]", *output_encoding_args(threads), f"{base}_body.mp4"]
+    return ffmpeg_command
+
+def finalize_parts(bases):
+    for base in bases:
+        append_end_credit(f"{base}_body.mp4", f"{base}.mp4", f"{base}_concat.txt")
+        logger.info(f"✅ Processed segment saved: {base}.mp4")
+    return [f"{base}.mp4" for base in bases]
+
+def drop_from_page_cache(paths):
+    # Each source segment is read exactly once; evict it once its encode is
+    # done so it doesn't push out pages the running encoders still need
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
 
+def remove_intermediates(bases):
+    for base in bases:
+        for suffix in INTERMEDIATE_SUFFIXES:
+            if os.path.exists(base + suffix):
+                os.remove(base + suffix)
+
+def encode_job_limit():
+    cpu_count = os.cpu_count() or 1
+    if VIDEO_ENCODER == "libx264":
+        # Leave headroom for x264's own frame threads
+        workers = cpu_count // 2
+    else:
+        # Consumer GPUs expose only one or two hardware encode engines and
+        # cap the number of open sessions, so keep workers x batch size small
+        workers = 2
+    return max(1, workers)
+
+# Shared by every request thread, so concurrent requests split the encoder
+# slots instead of each one claiming the whole limit
+ENCODE_JOB_LIMIT = encode_job_limit()
+encode_slots = threading.BoundedSemaphore(ENCODE_JOB_LIMIT)
+
+def segment_workers(job_count):
+    return max(1, min(job_count, ENCODE_JOB_LIMIT))
+
+def encoder_threads(batch_size):
+    # -threads applies per output, so split the cores between every encoder
+    # the process can have open at once across all requests
+    return max(1, (os.cpu_count() or 1) // (ENCODE_JOB_LIMIT * batch_size))
+
+def process_segment(segment_path, idx, movie_name, output_dir):
+    require_assets()
+    batch = [(segment_path, idx)]
+    bases = segment_bases(batch, movie_name, output_dir)
     try:
-        subprocess.run(ffmpeg_command, check=True)
-        logger.info(f"✅ Processed segment saved: {output_file}")
-        return output_file
+        command = batch_command(batch, bases, movie_name, encoder_threads(len(batch)))
+        with encode_slots:
+            subprocess.run(command, check=True)
+        drop_from_page_cache([segment_path])
+        return finalize_parts(bases)[0]
     except subprocess.CalledProcessError as e:
         logger.error(f"❌ Error: {e}")
         raise
+    finally:
+        remove_intermediates(bases)
+
+def next_finished_job(done):
+    job, proc = done.get()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return job
+
+def run_ffmpeg_jobs(commands, max_workers):
+    # The work happens inside the ffmpeg processes, so plain Popen is enough;
+    # each job holds one of the process-wide encode slots while it runs, at most
+    # max_workers of them per call, and its index is yielded as soon as it exits
+    # cleanly so callers can use its output while the rest encode
+    done = queue.Queue()
+    procs = []
+    finished = 0
+
+    def watch(job, proc):
+        proc.wait()
+        encode_slots.release()
+        done.put((job, proc))
+
+    try:
+        for job, command in enumerate(commands):
+            while len(procs) - finished >= max_workers:
+                yield next_finished_job(done)
+                finished += 1
+            # Hand back parts that are already done before waiting on a
+            # slot other requests may be holding
+            while not done.empty():
+                yield next_finished_job(done)
+                finished += 1
+            encode_slots.acquire()
+            try:
+                proc = subprocess.Popen(command)
+            except OSError:
+                encode_slots.release()
+                raise
+            procs.append(proc)
+            threading.Thread(target=watch, args=(job, proc), daemon=True).start()
+        while finished < len(procs):
+            yield next_finished_job(done)
+            finished += 1
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+def iter_processed_segments(segments, movie_name, output_dir):
+    # Yields (part number, output file) as each small batch finishes, so
+    # uploads can start while later batches are still encoding; each batch's
+    # sources leave the page cache and its intermediates are deleted as soon as it is done
+    if not segments:
+        return
+    require_assets()
+
+    indexed = [(segment, idx) for idx, segment in enumerate(segments, 1)]
+    batch_size = Config.SEGMENT_BATCH_SIZE
+    batches = [indexed[i:i + batch_size] for i in range(0, len(indexed), batch_size)]
+    max_workers = segment_workers(len(batches))
+    threads_per_encoder = encoder_threads(min(batch_size, len(indexed)))
+    logger.info(f"⚙️ Processing {len(indexed)} segments in {len(batches)} batches, {threads_per_encoder} threads per encoder")
+
+    batch_bases = [segment_bases(batch, movie_name, output_dir) for batch in batches]
+    jobs = None
+    try:
+        # Built lazily so captions and filter scripts are only written once a job is admitted
+        commands = (batch_command(batch, bases, movie_name, threads_per_encoder) for batch, bases in zip(batches, batch_bases))
+        jobs = run_ffmpeg_jobs(commands, max_workers)
+        for job in jobs:
+            drop_from_page_cache([segment for segment, _ in batches[job]])
+            for (_, idx), base in zip(batches[job], batch_bases[job]):
+                yield idx, finalize_parts([base])[0]
+            remove_intermediates(batch_bases[job])
+    except subprocess.CalledProcessError as e:
+        logger.error(f"❌ Error: {e}")
+        raise
+    finally:
+        # Stop any encodes still running before removing the files they write
+        if jobs is not None:
+            jobs.close()
+        for bases in batch_bases:
+            remove_intermediates(bases)
+
+def process_segments(segments, movie_name, output_dir):
+    processed = iter_processed_segments(segments, movie_name, output_dir)
+    return [output_file for _, output_file in sorted(processed)]
 
 # The rest of your existing application code should follow here...
 
 if __name__ == '__main__':
+    if os.getenv('FLASK_ENV') != 'development':
+        # The dev server handles one movie at a time; production serves wsgi:app
+        sys.exit("Run under gunicorn: gunicorn -w 1 -k gthread --threads 8 --timeout 0 -b 0.0.0.0:$PORT wsgi:app")
     port = int(os.environ.get('PORT', 5000))
-    app.run(debug=False, host='0.0.0.0', port=port)
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+    app.run(debug=False, host='0.0.0.0', port=port, threaded=True)
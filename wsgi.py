@@ -0,0 +1,3 @@
+from app import app
+
+# WSGI entrypoint for gunicorn; the Dockerfile CMD is the canonical command line